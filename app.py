@@ -3,46 +3,81 @@
 ###############################################
 
 from flask import (
-    Flask, render_template, request, redirect,
-    url_for, session, flash, send_file, send_from_directory, jsonify
+    Blueprint, Flask, current_app, render_template, request, redirect,
+    url_for, session, flash, send_from_directory
 )
 from flask_sqlalchemy import SQLAlchemy
 from functools import wraps
 import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 from datetime import datetime, date
-from io import BytesIO
 
+import click
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import generate_password_hash, check_password_hash
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
-from sqlalchemy import inspect, text
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import Session, contains_eager
 
 # ——————————————————————————————
 # AUCUNE IA — AUCUN CHARGEMENT .env
 # ——————————————————————————————
 
-app = Flask(__name__)
-app.secret_key = "dev-secret"
-
 # ============================================================
-#                    CONFIG BASE DE DONNÉES
+#                         CONFIGURATION
 # ============================================================
 
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///crm.db"
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+class Config:
+    SECRET_KEY = os.environ.get("SECRET_KEY", "dev-secret")
+    SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL", "sqlite:///crm.db")
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # Méthode werkzeug complète (coût inclus) : tout hachage d'une autre
+    # méthode est recalculé à la connexion réussie suivante
+    PASSWORD_HASH_METHOD = "scrypt:32768:8:1"
+
+    # Hachages hors du thread de requête, sur la moitié des cœurs au plus
+    LOGIN_HASH_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+    LOGIN_HASH_TIMEOUT = 10  # secondes
+
+    # Limitation des tentatives (seaux à jetons en mémoire, par processus),
+    # vérifiée avant tout hachage. Une connexion réussie rend son jeton IP et
+    # vide le seau de l'utilisateur, qui n'est plus appliqué depuis cette IP.
+    # Le seau IP est partagé par tout un bureau derrière un NAT : le
+    # dimensionner sur les échecs attendus de l'ensemble des postes, pas sur
+    # le nombre de connexions.
+    LOGIN_THROTTLE_ENABLED = True
+    LOGIN_USER_BURST = 5
+    LOGIN_USER_PER_MINUTE = 5
+    LOGIN_IP_BURST = 30
+    LOGIN_IP_PER_MINUTE = 30
+
+    # Nombre de proxys inverses de confiance devant l'application
+    # (X-Forwarded-For / X-Forwarded-Proto) ; 0 = connexion directe
+    PROXY_FIX_COUNT = 0
+
+    # None = dossier par défaut sous app.root_path
+    UPLOAD_FOLDER = None
+    CHAT_UPLOAD_FOLDER = None
 
-UPLOAD_FOLDER = os.path.join(app.root_path, "uploads")
-CHAT_UPLOAD_FOLDER = os.path.join(app.root_path, "chat_uploads")
 
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-os.makedirs(CHAT_UPLOAD_FOLDER, exist_ok=True)
+class DevelopmentConfig(Config):
+    DEBUG = True
+
+
+class TestingConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = "sqlite:///:memory:"
+    PASSWORD_HASH_METHOD = "pbkdf2:sha256:1000"
 
-app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
-app.config["CHAT_UPLOAD_FOLDER"] = CHAT_UPLOAD_FOLDER
 
 ALLOWED_EXTENSIONS = {"pdf"}
 
-db = SQLAlchemy(app)
+# Extensions et routes sans application : liées dans create_app()
+db = SQLAlchemy()
+bp = Blueprint("crm", __name__)
 
 CLIENT_STATUSES = [
     "en cours",
@@ -61,12 +96,19 @@ def allowed_file(filename: str) -> bool:
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def upload_folder(key: str) -> str:
+    # Dossier créé au premier envoi de fichier, pas au démarrage
+    folder = current_app.config[key]
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
 def login_required(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
         if "user_id" not in session:
             flash("Veuillez vous connecter.", "error")
-            return redirect(url_for("login"))
+            return redirect(url_for("crm.login"))
         return f(*args, **kwargs)
     return wrapper
 
@@ -76,10 +118,129 @@ def admin_required(f):
     def wrapper(*args, **kwargs):
         if session.get("role") != "admin":
             flash("Accès réservé à l’administrateur.", "error")
-            return redirect(url_for("dashboard"))
+            return redirect(url_for("crm.dashboard"))
         return f(*args, **kwargs)
     return wrapper
 
+# ============================================================
+#                     SÉCURITÉ DE LA CONNEXION
+# ============================================================
+
+class TokenBucket:
+    """Un seau à jetons par clé : `burst` essais, puis `per_minute` par minute."""
+
+    # Au-delà, les clés les moins récemment utilisées sont oubliées
+    MAX_KEYS = 10_000
+
+    def __init__(self, burst: int, per_minute: float):
+        self.burst = burst
+        self.rate = per_minute / 60.0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+
+            while len(self._buckets) > self.MAX_KEYS:
+                self._buckets.popitem(last=False)
+            return allowed
+
+    def give(self, key):
+        # Rembourse un jeton (tentative qui ne doit pas compter)
+        with self._lock:
+            if key in self._buckets:
+                tokens, last = self._buckets[key]
+                self._buckets[key] = (min(self.burst, tokens + 1), last)
+
+    def reset(self, key):
+        with self._lock:
+            self._buckets.pop(key, None)
+
+
+class LoginPipeline:
+    """Hachage sur un pool borné + limitation par utilisateur et par IP."""
+
+    def __init__(self, config):
+        self.method = config["PASSWORD_HASH_METHOD"]
+        self._prefix = None
+        self.timeout = config["LOGIN_HASH_TIMEOUT"]
+        self.executor = ThreadPoolExecutor(
+            max_workers=config["LOGIN_HASH_WORKERS"],
+            thread_name_prefix="login-hash",
+        )
+
+        self.throttle = config["LOGIN_THROTTLE_ENABLED"]
+        self.by_user = TokenBucket(config["LOGIN_USER_BURST"], config["LOGIN_USER_PER_MINUTE"])
+        self.by_ip = TokenBucket(config["LOGIN_IP_BURST"], config["LOGIN_IP_PER_MINUTE"])
+
+        # (utilisateur, IP) déjà connectés avec succès : exemptés du seau
+        # utilisateur, pour qu'un attaquant ne puisse pas bloquer le titulaire
+        self._trusted = OrderedDict()
+        self._trusted_lock = threading.Lock()
+
+    def allow(self, username: str, ip: str) -> bool:
+        # Avant tout hachage : chaque essai est débité, puis remboursé en
+        # cas de succès ; un seau vide refuse sans calculer de hachage
+        if not self.throttle:
+            return True
+
+        ip, username = ip or "", username.lower()
+        if not self.by_ip.take(ip):
+            return False
+
+        with self._trusted_lock:
+            if (username, ip) in self._trusted:
+                self._trusted.move_to_end((username, ip))
+                return True
+
+        return self.by_user.take(username)
+
+    def succeeded(self, username: str, ip: str):
+        if not self.throttle:
+            return
+
+        ip, username = ip or "", username.lower()
+        self.by_ip.give(ip)
+        self.by_user.reset(username)
+
+        with self._trusted_lock:
+            self._trusted[(username, ip)] = True
+            self._trusted.move_to_end((username, ip))
+            while len(self._trusted) > TokenBucket.MAX_KEYS:
+                self._trusted.popitem(last=False)
+
+    def _run(self, fn, *args):
+        # FutureTimeout si le pool est saturé plus longtemps que `timeout`
+        future = self.executor.submit(fn, *args)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeout:
+            future.cancel()
+            raise
+
+    def verify(self, pwhash: str, password: str) -> bool:
+        return self._run(check_password_hash, pwhash, password)
+
+    def hash(self, password: str) -> str:
+        return self._run(generate_password_hash, password, self.method)
+
+    def needs_rehash(self, pwhash: str) -> bool:
+        # Préfixe canonique ("scrypt" -> "scrypt:32768:8:1"), calculé au
+        # premier usage pour ne pas payer un hachage dans create_app()
+        if self._prefix is None:
+            self._prefix = generate_password_hash("", self.method).split("$", 1)[0]
+        return pwhash.split("$", 1)[0] != self._prefix
+
+
+def login_pipeline() -> LoginPipeline:
+    return current_app.extensions["crm_login"]
+
 # ============================================================
 #                           MODÈLES
 # ============================================================
@@ -96,10 +257,9 @@ class User(db.Model):
     messages = db.relationship("Message", backref="user", lazy=True)
 
     def set_password(self, pwd: str):
-        self.password_hash = generate_password_hash(pwd)
-
-    def check_password(self, pwd: str) -> bool:
-        return check_password_hash(self.password_hash, pwd)
+        self.password_hash = generate_password_hash(
+            pwd, current_app.config["PASSWORD_HASH_METHOD"]
+        )
 
 
 class Client(db.Model):
@@ -111,9 +271,17 @@ class Client(db.Model):
     notes = db.Column(db.Text)
 
     commercial = db.Column(db.String(120), nullable=False)
-    status = db.Column(db.String(50), nullable=False, default="en cours")
+    # active_history : l'ancienne valeur reste connue pour l'historique
+    status = db.column_property(
+        db.Column(db.String(50), nullable=False, default="en cours"),
+        active_history=True,
+    )
+    status_since = db.Column(db.DateTime, default=datetime.utcnow)
 
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    user_id = db.column_property(
+        db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False),
+        active_history=True,
+    )
 
     appointments = db.relationship("Appointment", backref="client", lazy=True)
     documents = db.relationship("Document", backref="client", lazy=True)
@@ -155,42 +323,237 @@ class Message(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     filename = db.Column(db.String(255))
     original_name = db.Column(db.String(255))
+
+
+class ClientStatusHistory(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    # Sans clé étrangère : l'historique survit à la suppression du client
+    client_id = db.Column(db.Integer, nullable=False, index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    from_status = db.Column(db.String(50))
+    to_status = db.Column(db.String(50), nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class StatusCounter(db.Model):
+    # Matrice commercial × statut, tenue à jour à chaque flush
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), primary_key=True)
+    status = db.Column(db.String(50), primary_key=True)
+
+    count = db.Column(db.Integer, nullable=False, default=0)    # clients actuels
+    entered = db.Column(db.Integer, nullable=False, default=0)  # entrées cumulées
+    exits = db.Column(db.Integer, nullable=False, default=0)    # sorties datées
+    seconds = db.Column(db.Float, nullable=False, default=0.0)  # durée totale des sorties
+
+    user = db.relationship("User", lazy=True)
+
+# ============================================================
+#                  PIPELINE : HISTORIQUE DES STATUTS
+# ============================================================
+# Chaque changement de Client.status ou de propriétaire écrit une ligne
+# d'historique et met à jour StatusCounter, pour que les rapports ne
+# parcourent jamais la table client. Règle commune au suivi en direct et
+# à rebuild_funnel() : une ligne d'historique = une entrée dans l'étape
+# pour son user_id, close par la ligne suivante du même client.
+
+COUNTER_FIELDS = ("count", "entered", "exits", "seconds")
+
+
+def _old_value(state, attr):
+    hist = state.attrs[attr].history
+    if hist.deleted:
+        return hist.deleted[0]
+    return getattr(state.object, attr)
+
+
+def _owner_changed(state, old_user) -> bool:
+    # Propriétaire changé par user_id ou via la relation `user`
+    # (user_id n'est alors renseigné qu'au flush)
+    added = state.attrs["user"].history.added
+    if added and added[0] is not None:
+        return added[0].id is None or added[0].id != old_user
+    return state.object.user_id != old_user
+
+
+@event.listens_for(Session, "before_flush")
+def stage_client_status(session, flush_context, instances):
+    # Avant le flush : anciennes valeurs et status_since ; les ids ne sont
+    # connus qu'après, voir record_client_status(). Les mouvements vivent sur
+    # le flush_context : un flush en échec ne les laisse pas traîner.
+    now = datetime.utcnow()
+    moves = flush_context.attributes.setdefault("client_moves", [])
+
+    for obj in session.new:
+        if isinstance(obj, Client):
+            obj.status = obj.status or CLIENT_STATUSES[0]
+            obj.status_since = now
+            moves.append((obj, None, None, None))
+
+    for obj in session.dirty:
+        if not isinstance(obj, Client):
+            continue
+
+        state = inspect(obj)
+        old_status = _old_value(state, "status")
+        old_user = _old_value(state, "user_id")
+
+        if old_status == obj.status and not _owner_changed(state, old_user):
+            continue
+
+        seconds = (now - obj.status_since).total_seconds() if obj.status_since else None
+        obj.status_since = now
+        moves.append((obj, old_user, old_status, seconds))
+
+    for obj in session.deleted:
+        if isinstance(obj, Client):
+            state = inspect(obj)
+            moves.append((None, _old_value(state, "user_id"), _old_value(state, "status"), None))
+
+
+@event.listens_for(Session, "after_flush")
+def record_client_status(session, flush_context):
+    moves = flush_context.attributes.get("client_moves")
+    if not moves:
+        return
+
+    deltas = {}
+    history = []
+
+    def add(user_id, status, **fields):
+        row = deltas.setdefault((user_id, status), dict.fromkeys(COUNTER_FIELDS, 0))
+        for name, value in fields.items():
+            row[name] += value
+
+    for obj, old_user, old_status, seconds in moves:
+        if old_user is not None:
+            add(old_user, old_status, count=-1)
+            if seconds is not None:
+                add(old_user, old_status, exits=1, seconds=seconds)
+        if obj is not None:
+            add(obj.user_id, obj.status, count=1, entered=1)
+            history.append({
+                "client_id": obj.id, "user_id": obj.user_id,
+                "from_status": old_status, "to_status": obj.status,
+                "changed_at": obj.status_since,
+            })
+
+    conn = session.connection()
+    if history:
+        conn.execute(ClientStatusHistory.__table__.insert(), history)
+    for (user_id, status), fields in deltas.items():
+        conn.execute(_counter_upsert(conn, user_id, status, fields))
+
+
+def _counter_upsert(conn, user_id, status, fields):
+    # INSERT ... ON CONFLICT DO UPDATE SET x = x + n : ni perte ni doublon
+    # quand deux workers touchent la même case
+    if conn.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+
+    table = StatusCounter.__table__
+    stmt = insert(table).values(user_id=user_id, status=status, **fields)
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.user_id, table.c.status],
+        set_={name: table.c[name] + value for name, value in fields.items() if value},
+    )
+
+
+def merge_counters(from_user_id, to_user_id):
+    conn = db.session.connection()
+    for c in StatusCounter.query.filter_by(user_id=from_user_id).all():
+        fields = {name: getattr(c, name) for name in COUNTER_FIELDS}
+        conn.execute(_counter_upsert(conn, to_user_id, c.status, fields))
+        db.session.delete(c)
+
+
+def funnel_by_commercial(user_id=None):
+    """Entonnoir par commercial, lu sur StatusCounter uniquement."""
+    query = StatusCounter.query.join(StatusCounter.user).options(
+        contains_eager(StatusCounter.user)
+    )
+    if user_id is not None:
+        query = query.filter(StatusCounter.user_id == user_id)
+
+    funnels = {}
+    for c in query.all():
+        funnel = funnels.setdefault(c.user_id, {
+            "commercial": c.user.username,
+            "stages": {s: {"count": 0, "entered": 0, "avg_days": None}
+                       for s in CLIENT_STATUSES},
+        })
+        funnel["stages"][c.status] = {
+            "count": c.count,
+            "entered": c.entered,
+            "avg_days": c.seconds / c.exits / 86400 if c.exits else None,
+        }
+
+    for funnel in funnels.values():
+        total = sum(s["count"] for s in funnel["stages"].values())
+        signed = funnel["stages"].get("contrat signé", {}).get("count", 0)
+        funnel["total"] = total
+        funnel["conversion"] = signed / total if total else None
+
+    return sorted(funnels.values(), key=lambda f: f["commercial"])
+
 # ============================================================
 #                           LOGIN / LOGOUT
 # ============================================================
 
-@app.route("/login", methods=["GET", "POST"])
+@bp.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
         username = request.form.get("username", "").strip()
         password = request.form.get("password", "")
 
+        pipeline = login_pipeline()
+
+        if not pipeline.allow(username, request.remote_addr):
+            flash("Trop de tentatives. Réessayez dans quelques minutes.", "error")
+            return render_template("login.html"), 429
+
         user = User.query.filter_by(username=username).first()
 
-        if user and user.check_password(password):
+        try:
+            valid = user is not None and pipeline.verify(user.password_hash, password)
+        except FutureTimeout:
+            flash("Serveur occupé, veuillez réessayer.", "error")
+            return render_template("login.html"), 503
+
+        if valid:
+            # Ancien hachage (méthode ou coût) : recalcul transparent
+            if pipeline.needs_rehash(user.password_hash):
+                try:
+                    user.password_hash = pipeline.hash(password)
+                    db.session.commit()
+                except FutureTimeout:
+                    pass
+
+            pipeline.succeeded(username, request.remote_addr)
             session["user_id"] = user.id
             session["username"] = user.username
             session["role"] = user.role
             flash("Connexion réussie", "success")
-            return redirect(url_for("dashboard"))
+            return redirect(url_for("crm.dashboard"))
 
         flash("Nom d’utilisateur ou mot de passe incorrect", "error")
 
     return render_template("login.html")
 
 
-@app.route("/logout")
+@bp.route("/logout")
 def logout():
     session.clear()
     flash("Déconnexion réussie", "info")
-    return redirect(url_for("login"))
+    return redirect(url_for("crm.login"))
 
 
 # ============================================================
 #              ADMIN : GESTION DES UTILISATEURS
 # ============================================================
 
-@app.route("/admin/users", methods=["GET", "POST"])
+@bp.route("/admin/users", methods=["GET", "POST"])
 @admin_required
 def admin_users():
     if request.method == "POST":
@@ -199,11 +562,11 @@ def admin_users():
 
         if not username or not password:
             flash("Nom d’utilisateur et mot de passe requis.", "error")
-            return redirect(url_for("admin_users"))
+            return redirect(url_for("crm.admin_users"))
 
         if User.query.filter_by(username=username).first():
             flash("Ce nom d’utilisateur existe déjà", "error")
-            return redirect(url_for("admin_users"))
+            return redirect(url_for("crm.admin_users"))
 
         new_user = User(username=username, role="commercial")
         new_user.set_password(password)
@@ -212,20 +575,20 @@ def admin_users():
         db.session.commit()
 
         flash("Commercial créé", "success")
-        return redirect(url_for("admin_users"))
+        return redirect(url_for("crm.admin_users"))
 
     users = User.query.all()
     return render_template("admin_users.html", users=users)
 
 
-@app.route("/admin/users/<int:user_id>/edit", methods=["GET", "POST"])
+@bp.route("/admin/users/<int:user_id>/edit", methods=["GET", "POST"])
 @admin_required
 def admin_edit_user(user_id):
     user = User.query.get_or_404(user_id)
 
     if user.role == "admin":
         flash("Impossible de modifier l'administrateur principal.", "error")
-        return redirect(url_for("admin_users"))
+        return redirect(url_for("crm.admin_users"))
 
     if request.method == "POST":
         user.username = request.form.get("username", "").strip()
@@ -236,19 +599,19 @@ def admin_edit_user(user_id):
 
         db.session.commit()
         flash("Utilisateur modifié", "success")
-        return redirect(url_for("admin_users"))
+        return redirect(url_for("crm.admin_users"))
 
     return render_template("admin_edit_user.html", user=user)
 
 
-@app.route("/admin/users/<int:user_id>/delete", methods=["POST"])
+@bp.route("/admin/users/<int:user_id>/delete", methods=["POST"])
 @admin_required
 def admin_delete_user(user_id):
     user = User.query.get_or_404(user_id)
 
     if user.role == "admin":
         flash("Impossible de supprimer l’admin.", "error")
-        return redirect(url_for("admin_users"))
+        return redirect(url_for("crm.admin_users"))
 
     admin_user = User.query.filter_by(role="admin").first()
 
@@ -261,26 +624,33 @@ def admin_delete_user(user_id):
         d.user_id = admin_user.id
     for m in Message.query.filter_by(user_id=user.id).all():
         m.user_id = admin_user.id
+    for h in ClientStatusHistory.query.filter_by(user_id=user.id).all():
+        h.user_id = admin_user.id
+
+    # Le flush transfère les clients ; l'historique du commercial, déjà
+    # réattribué, emporte ses compteurs avec lui
+    db.session.flush()
+    merge_counters(user.id, admin_user.id)
 
     db.session.delete(user)
     db.session.commit()
 
     flash("Utilisateur supprimé", "info")
-    return redirect(url_for("admin_users"))
+    return redirect(url_for("crm.admin_users"))
 
 
 # ============================================================
 #                           DASHBOARD
 # ============================================================
 
-@app.route("/")
+@bp.route("/")
 def index():
     if "user_id" in session:
-        return redirect(url_for("dashboard"))
-    return redirect(url_for("login"))
+        return redirect(url_for("crm.dashboard"))
+    return redirect(url_for("crm.login"))
 
 
-@app.route("/dashboard")
+@bp.route("/dashboard")
 @login_required
 def dashboard():
     user_id = session["user_id"]
@@ -314,11 +684,15 @@ def dashboard():
         "rdv_cette_semaine": rdv_count,
     }
 
+    funnels = funnel_by_commercial(None if role == "admin" else user_id)
+
     return render_template(
         "dashboard.html",
         stats=stats,
         upcoming_appointments=upcoming,
         latest_docs=latest_docs,
+        funnels=funnels,
+        statuses=CLIENT_STATUSES,
     )
 
 
@@ -326,7 +700,7 @@ def dashboard():
 #                           CLIENTS
 # ============================================================
 
-@app.route("/clients")
+@bp.route("/clients")
 @login_required
 def clients():
     q = request.args.get("q", "")
@@ -349,7 +723,7 @@ def clients():
     return render_template("clients.html", clients=all_clients, q=q)
 
 
-@app.route("/clients/new", methods=["GET", "POST"])
+@bp.route("/clients/new", methods=["GET", "POST"])
 @login_required
 def new_client():
     if request.method == "POST":
@@ -368,7 +742,7 @@ def new_client():
         db.session.commit()
 
         flash("Client ajouté", "success")
-        return redirect(url_for("clients"))
+        return redirect(url_for("crm.clients"))
 
     return render_template(
         "client_form.html",
@@ -380,7 +754,7 @@ def new_client():
 #                         RENDEZ-VOUS
 # ============================================================
 
-@app.route("/appointments")
+@bp.route("/appointments")
 @login_required
 def list_appointments():
     user_id = session["user_id"]
@@ -401,7 +775,7 @@ def list_appointments():
     return render_template("appointments.html", appointments=appointments)
 
 
-@app.route("/appointments/new", methods=["GET", "POST"])
+@bp.route("/appointments/new", methods=["GET", "POST"])
 @login_required
 def new_appointment():
     client_id = request.args.get("client_id")
@@ -427,13 +801,13 @@ def new_appointment():
         flash("RDV ajouté", "success")
 
         if client:
-            return redirect(url_for("client_detail", client_id=client.id))
-        return redirect(url_for("list_appointments"))
+            return redirect(url_for("crm.client_detail", client_id=client.id))
+        return redirect(url_for("crm.list_appointments"))
 
     return render_template("appointment_form.html", rdv=None, client=client, action="new")
 
 
-@app.route("/appointments/<int:appointment_id>/edit", methods=["GET", "POST"])
+@bp.route("/appointments/<int:appointment_id>/edit", methods=["GET", "POST"])
 @login_required
 def edit_appointment(appointment_id):
     rdv = Appointment.query.get_or_404(appointment_id)
@@ -441,7 +815,7 @@ def edit_appointment(appointment_id):
 
     if session["role"] != "admin" and rdv.user_id != session["user_id"]:
         flash("Accès interdit", "error")
-        return redirect(url_for("list_appointments"))
+        return redirect(url_for("crm.list_appointments"))
 
     if request.method == "POST":
         rdv.title = request.form.get("title")
@@ -454,20 +828,20 @@ def edit_appointment(appointment_id):
         flash("RDV modifié", "success")
 
         if client:
-            return redirect(url_for("client_detail", client_id=client.id))
-        return redirect(url_for("list_appointments"))
+            return redirect(url_for("crm.client_detail", client_id=client.id))
+        return redirect(url_for("crm.list_appointments"))
 
     return render_template("appointment_form.html", rdv=rdv, client=client, action="edit")
 
 
-@app.route("/appointments/<int:appointment_id>/delete", methods=["POST"])
+@bp.route("/appointments/<int:appointment_id>/delete", methods=["POST"])
 @login_required
 def delete_appointment(appointment_id):
     rdv = Appointment.query.get_or_404(appointment_id)
 
     if session["role"] != "admin" and rdv.user_id != session["user_id"]:
         flash("Accès interdit", "error")
-        return redirect(url_for("list_appointments"))
+        return redirect(url_for("crm.list_appointments"))
 
     client = rdv.client
     db.session.delete(rdv)
@@ -476,15 +850,15 @@ def delete_appointment(appointment_id):
     flash("RDV supprimé", "info")
 
     if client:
-        return redirect(url_for("client_detail", client_id=client.id))
-    return redirect(url_for("list_appointments"))
+        return redirect(url_for("crm.client_detail", client_id=client.id))
+    return redirect(url_for("crm.list_appointments"))
 
 
 # ============================================================
 #                        DOCUMENTS PDF
 # ============================================================
 
-@app.route("/documents")
+@bp.route("/documents")
 @login_required
 def documents():
     role = session["role"]
@@ -496,7 +870,7 @@ def documents():
     return render_template("documents.html", documents=docs)
 
 
-@app.route("/documents/upload", methods=["POST"])
+@bp.route("/documents/upload", methods=["POST"])
 @login_required
 def upload_document():
     file = request.files.get("file")
@@ -507,16 +881,16 @@ def upload_document():
 
     if not file or file.filename == "":
         flash("Aucun fichier envoyé", "error")
-        return redirect(request.referrer or url_for("documents"))
+        return redirect(request.referrer or url_for("crm.documents"))
 
     if not allowed_file(file.filename):
         flash("Seuls les fichiers PDF sont autorisés.", "error")
-        return redirect(request.referrer or url_for("documents"))
+        return redirect(request.referrer or url_for("crm.documents"))
 
     original = file.filename
     safe_name = f"{int(datetime.utcnow().timestamp())}_{original}"
 
-    file.save(os.path.join(app.config["UPLOAD_FOLDER"], safe_name))
+    file.save(os.path.join(upload_folder("UPLOAD_FOLDER"), safe_name))
 
     doc = Document(
         filename=safe_name,
@@ -529,36 +903,36 @@ def upload_document():
     db.session.commit()
 
     flash("PDF importé", "success")
-    return redirect(request.referrer or url_for("documents"))
+    return redirect(request.referrer or url_for("crm.documents"))
 
 
-@app.route("/documents/<int:doc_id>/download")
+@bp.route("/documents/<int:doc_id>/download")
 @login_required
 def download_document(doc_id):
     doc = Document.query.get_or_404(doc_id)
 
     if session["role"] != "admin" and doc.user_id != session["user_id"]:
         flash("Accès interdit", "error")
-        return redirect(url_for("documents"))
+        return redirect(url_for("crm.documents"))
 
     return send_from_directory(
-        app.config["UPLOAD_FOLDER"],
+        current_app.config["UPLOAD_FOLDER"],
         doc.filename,
         as_attachment=True,
         download_name=doc.original_name,
     )
 
 
-@app.route("/documents/<int:doc_id>/delete", methods=["POST"])
+@bp.route("/documents/<int:doc_id>/delete", methods=["POST"])
 @login_required
 def delete_document(doc_id):
     doc = Document.query.get_or_404(doc_id)
 
     if session["role"] != "admin" and doc.user_id != session["user_id"]:
         flash("Accès interdit", "error")
-        return redirect(url_for("documents"))
+        return redirect(url_for("crm.documents"))
 
-    path = os.path.join(app.config["UPLOAD_FOLDER"], doc.filename)
+    path = os.path.join(current_app.config["UPLOAD_FOLDER"], doc.filename)
     if os.path.exists(path):
         os.remove(path)
 
@@ -566,14 +940,14 @@ def delete_document(doc_id):
     db.session.commit()
 
     flash("Document supprimé", "info")
-    return redirect(url_for("documents"))
+    return redirect(url_for("crm.documents"))
 
 
 # ============================================================
 #                       CHIFFRE D’AFFAIRES
 # ============================================================
 
-@app.route("/chiffre_affaire", methods=["GET", "POST"])
+@bp.route("/chiffre_affaire", methods=["GET", "POST"])
 @login_required
 def chiffre_affaire():
     if request.method == "POST":
@@ -582,7 +956,7 @@ def chiffre_affaire():
             date_val = datetime.strptime(request.form.get("date"), "%Y-%m-%d").date()
         except:
             flash("Montant ou date invalide.", "error")
-            return redirect(url_for("chiffre_affaire"))
+            return redirect(url_for("crm.chiffre_affaire"))
 
         entry = Revenue(
             commercial=session["username"],
@@ -594,7 +968,7 @@ def chiffre_affaire():
         db.session.commit()
 
         flash("Montant ajouté", "success")
-        return redirect(url_for("chiffre_affaire"))
+        return redirect(url_for("crm.chiffre_affaire"))
 
     if session["role"] == "admin":
         entries = Revenue.query.order_by(Revenue.date.desc()).all()
@@ -613,14 +987,14 @@ def chiffre_affaire():
 #                          CHAT D'ÉQUIPE
 # ============================================================
 
-@app.route("/chat")
+@bp.route("/chat")
 @login_required
 def chat():
     msgs = Message.query.order_by(Message.timestamp.asc()).all()
     return render_template("chat.html", messages=msgs)
 
 
-@app.route("/chat/send", methods=["POST"])
+@bp.route("/chat/send", methods=["POST"])
 @login_required
 def chat_send():
     content = (request.form.get("message") or "").strip()
@@ -633,13 +1007,13 @@ def chat_send():
     if file and file.filename:
         original_name = file.filename
         safe_name = f"{int(datetime.utcnow().timestamp())}_{original_name}"
-        file.save(os.path.join(app.config["CHAT_UPLOAD_FOLDER"], safe_name))
+        file.save(os.path.join(upload_folder("CHAT_UPLOAD_FOLDER"), safe_name))
         filename = safe_name
 
     # Si message vide ET aucun fichier -> erreur
     if not content and not filename:
         flash("Message vide : écrivez un texte ou joignez un fichier.", "error")
-        return redirect(url_for("chat"))
+        return redirect(url_for("crm.chat"))
 
     msg = Message(
         user_id=session["user_id"],
@@ -651,20 +1025,20 @@ def chat_send():
     db.session.add(msg)
     db.session.commit()
 
-    return redirect(url_for("chat"))
+    return redirect(url_for("crm.chat"))
 
 
-@app.route("/chat/file/<int:msg_id>")
+@bp.route("/chat/file/<int:msg_id>")
 @login_required
 def chat_download(msg_id):
     msg = Message.query.get_or_404(msg_id)
 
     if not msg.filename:
         flash("Aucun fichier joint.", "error")
-        return redirect(url_for("chat"))
+        return redirect(url_for("crm.chat"))
 
     return send_from_directory(
-        app.config["CHAT_UPLOAD_FOLDER"],
+        current_app.config["CHAT_UPLOAD_FOLDER"],
         msg.filename,
         as_attachment=True,
         download_name=msg.original_name or msg.filename,
@@ -672,10 +1046,12 @@ def chat_download(msg_id):
 
 
 # ============================================================
-#                 INITIALISATION DB + ADMIN AUTO
+#                 INITIALISATION DB + ADMIN
 # ============================================================
+# Exécutées une seule fois (commandes flask), jamais à l'import :
+# les workers gunicorn ne se disputent plus les ALTER TABLE.
 
-with app.app_context():
+def init_schema():
     db.create_all()
 
     inspector = inspect(db.engine)
@@ -699,18 +1075,148 @@ with app.app_context():
         with db.engine.begin() as conn:
             conn.execute(text("ALTER TABLE message ADD COLUMN original_name VARCHAR(255)"))
 
-    # Création auto de l'admin si aucun admin trouvé
-    if not User.query.filter_by(role="admin").first():
-        admin = User(username="admin", role="admin")
-        admin.set_password("admin123")
-        db.session.add(admin)
-        db.session.commit()
-        print(">>> ADMIN CRÉÉ (admin / admin123)")
+    if "status_since" not in cols:
+        with db.engine.begin() as conn:
+            conn.execute(text("ALTER TABLE client ADD COLUMN status_since DATETIME"))
+
+    # Base existante sans compteurs : les construire avant tout changement
+    # de statut, sinon le suivi en direct partirait de zéro (comptes négatifs)
+    if Client.query.first() and not StatusCounter.query.first():
+        rebuild_funnel()
+
+
+def ensure_admin(username: str = "admin", password: str = "admin123") -> bool:
+    # Création de l'admin si aucun admin trouvé
+    if User.query.filter_by(role="admin").first():
+        return False
+
+    admin = User(username=username, role="admin")
+    admin.set_password(password)
+    db.session.add(admin)
+    db.session.commit()
+    return True
+
+
+@click.command("init-db")
+def init_db_command():
+    """Crée les tables, ajoute les colonnes manquantes, initialise l'entonnoir."""
+    init_schema()
+    click.echo("Base de données initialisée.")
+
+
+def rebuild_funnel():
+    # Recalcul complet (O(clients + historique)) depuis l'historique, avec
+    # la même règle que le suivi en direct : réparation idempotente
+    now = datetime.utcnow()
+    tracked = {cid for (cid,) in db.session.query(ClientStatusHistory.client_id).distinct()}
+
+    # Clients antérieurs à l'historique : entrée de référence à l'instant
+    # présent, les durées sont comptées à partir de là
+    for client in Client.query.all():
+        if client.id not in tracked:
+            client.status_since = now
+            db.session.add(ClientStatusHistory(
+                client_id=client.id, user_id=client.user_id,
+                to_status=client.status, changed_at=now,
+            ))
+    db.session.flush()
+
+    counters = {}
+
+    def counter(user_id, status):
+        key = (user_id, status)
+        if key not in counters:
+            counters[key] = StatusCounter(
+                user_id=user_id, status=status, count=0, entered=0, exits=0, seconds=0.0,
+            )
+        return counters[key]
+
+    for client in Client.query.all():
+        counter(client.user_id, client.status).count += 1
+
+    history = {}
+    for h in ClientStatusHistory.query.order_by(
+        ClientStatusHistory.changed_at.asc(), ClientStatusHistory.id.asc()
+    ).all():
+        history.setdefault(h.client_id, []).append(h)
+
+    for rows in history.values():
+        for prev, nxt in zip(rows, rows[1:] + [None]):
+            c = counter(prev.user_id, prev.to_status)
+            c.entered += 1
+            if nxt is not None:
+                c.exits += 1
+                c.seconds += (nxt.changed_at - prev.changed_at).total_seconds()
+
+    StatusCounter.query.delete()
+    db.session.add_all(counters.values())
+    db.session.commit()
+    return len(counters)
+
+
+@click.command("rebuild-funnel")
+def rebuild_funnel_command():
+    """Recalcule la matrice commercial × statut depuis les clients."""
+    n = rebuild_funnel()
+    click.echo(f"Entonnoir recalculé ({n} compteurs).")
+
+
+@click.command("create-admin")
+@click.option("--username", default="admin", show_default=True)
+@click.option("--password", default="admin123", show_default=True)
+def create_admin_command(username, password):
+    """Crée le compte administrateur s'il n'existe pas."""
+    if ensure_admin(username, password):
+        click.echo(f">>> ADMIN CRÉÉ ({username})")
+    else:
+        click.echo("Un administrateur existe déjà.")
+
+
+# ============================================================
+#                     FABRIQUE D'APPLICATION
+# ============================================================
+
+def create_app(config_class=Config):
+    app = Flask(__name__)
+    app.config.from_object(config_class)
+
+    app.config["UPLOAD_FOLDER"] = (
+        app.config["UPLOAD_FOLDER"] or os.path.join(app.root_path, "uploads")
+    )
+    app.config["CHAT_UPLOAD_FOLDER"] = (
+        app.config["CHAT_UPLOAD_FOLDER"] or os.path.join(app.root_path, "chat_uploads")
+    )
+
+    if app.config["PROXY_FIX_COUNT"]:
+        n = app.config["PROXY_FIX_COUNT"]
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=n, x_proto=n)
+
+    db.init_app(app)
+    app.extensions["crm_login"] = LoginPipeline(app.config)
+    app.register_blueprint(bp)
+
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(create_admin_command)
+    app.cli.add_command(rebuild_funnel_command)
+
+    return app
 
 
 # ============================================================
 #                          LANCEMENT
 # ============================================================
+# Production : gunicorn "app:create_app()" après
+#   flask init-db && flask create-admin
+# init-db est obligatoire à chaque mise à jour du schéma : il construit
+# aussi l'entonnoir des clients existants (flask rebuild-funnel = réparation)
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    app = create_app(DevelopmentConfig)
+
+    # Serveur de dev mono-processus : initialisation directe
+    with app.app_context():
+        init_schema()
+        if ensure_admin():
+            print(">>> ADMIN CRÉÉ (admin / admin123)")
+
+    app.run()
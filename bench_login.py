@@ -0,0 +1,137 @@
+###############################################
+#   Test de charge : latence pendant un afflux de connexions
+###############################################
+#
+# Le serveur (werkzeug multi-thread) tourne dans un processus séparé sur
+# une base SQLite temporaire. Pendant qu'une rafale de POST /login
+# (mauvais mot de passe) tourne, un client connecté mesure la latence
+# de GET /dashboard.
+#
+#   python bench_login.py [secondes] [threads_rafale]
+
+import http.cookiejar
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+PORT = 5077
+BASE = f"http://127.0.0.1:{PORT}"
+
+
+def serve(db_path: str, throttle: bool, workers: int):
+    from werkzeug.serving import make_server
+    from app import Config, create_app, ensure_admin, init_schema
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{db_path}"
+        LOGIN_THROTTLE_ENABLED = throttle
+        LOGIN_HASH_WORKERS = workers or Config.LOGIN_HASH_WORKERS
+
+    app = create_app(BenchConfig)
+    with app.app_context():
+        init_schema()
+        ensure_admin()
+
+    make_server("127.0.0.1", PORT, app, threaded=True).serve_forever()
+
+
+def post_login(opener, username, password) -> int:
+    data = urllib.parse.urlencode({"username": username, "password": password}).encode()
+    try:
+        return opener.open(f"{BASE}/login", data).status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def storm(stop: threading.Event, counts: dict, lock: threading.Lock):
+    opener = urllib.request.build_opener()
+    i = 0
+    while not stop.is_set():
+        i += 1
+        status = post_login(opener, "admin", f"mauvais-{i}")
+        with lock:
+            counts[status] = counts.get(status, 0) + 1
+
+
+def measure(duration: float, storm_threads: int, throttle: bool, workers: int) -> dict:
+    db_path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    server = subprocess.Popen(
+        [sys.executable, __file__, "--serve", db_path, "1" if throttle else "0", str(workers)],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(f"{BASE}/login")
+                break
+            except OSError:
+                time.sleep(0.1)
+
+        user = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+        )
+        post_login(user, "admin", "admin123")
+
+        stop = threading.Event()
+        counts, lock = {}, threading.Lock()
+        workers = [
+            threading.Thread(target=storm, args=(stop, counts, lock))
+            for _ in range(storm_threads)
+        ]
+        for w in workers:
+            w.start()
+
+        latencies = []
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            t0 = time.perf_counter()
+            user.open(f"{BASE}/dashboard").read()
+            latencies.append((time.perf_counter() - t0) * 1000)
+
+        stop.set()
+        for w in workers:
+            w.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies.sort()
+    return {
+        "n": len(latencies),
+        "p50": statistics.median(latencies),
+        "p95": latencies[int(len(latencies) * 0.95) - 1],
+        "logins": counts,
+    }
+
+
+def main():
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    storm_threads = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+
+    # Un worker par thread de rafale ~ hachage direct dans chaque requête
+    # (comportement d'avant) ; 0 = LOGIN_HASH_WORKERS par défaut
+    scenarios = [
+        ("sans rafale", 0, True, 0),
+        ("rafale, pool non borné", storm_threads, False, storm_threads),
+        ("rafale, pool borné", storm_threads, False, 0),
+        ("rafale, pool borné + limitation", storm_threads, True, 0),
+    ]
+    for label, threads, throttle, workers in scenarios:
+        r = measure(duration, threads, throttle, workers)
+        print(f"{label:<32} /dashboard p50 {r['p50']:7.1f} ms  p95 {r['p95']:7.1f} ms"
+              f"  ({r['n']} req.)  /login par statut : {r['logins']}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--serve":
+        serve(sys.argv[2], sys.argv[3] == "1", int(sys.argv[4]))
+    else:
+        main()
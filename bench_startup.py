@@ -0,0 +1,66 @@
+###############################################
+#     Benchmark démarrage : import + 1re requête
+###############################################
+#
+# Chaque mesure tourne dans un processus Python neuf (import à froid).
+#
+#   python bench_startup.py                 # arbre courant
+#   git worktree add /tmp/crm-avant <rev>
+#   python bench_startup.py /tmp/crm-avant  # version à comparer
+
+import json
+import statistics
+import subprocess
+import sys
+
+PROBE = r"""
+import json, sys, time
+sys.path.insert(0, sys.argv[1])
+
+t0 = time.perf_counter()
+import app as module
+t1 = time.perf_counter()
+
+if hasattr(module, "create_app"):
+    application = module.create_app()
+else:
+    application = module.app
+t2 = time.perf_counter()
+
+resp = application.test_client().get("/login")
+t3 = time.perf_counter()
+
+print(json.dumps({
+    "import": t1 - t0,
+    "create_app": t2 - t1,
+    "first_request": t3 - t2,
+    "status": resp.status_code,
+    "reportlab": "reportlab" in sys.modules,
+}))
+"""
+
+
+def run_once(path: str) -> dict:
+    out = subprocess.run(
+        [sys.executable, "-c", PROBE, path],
+        cwd=path, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else "."
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    results = [run_once(path) for _ in range(runs)]
+
+    print(f"{path} — {runs} processus, statut /login = {results[0]['status']}, "
+          f"reportlab chargé = {results[0]['reportlab']}")
+    for key in ("import", "create_app", "first_request"):
+        values = [r[key] * 1000 for r in results]
+        print(f"  {key:<14} médiane {statistics.median(values):8.1f} ms"
+              f"   max {max(values):8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
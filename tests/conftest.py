@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import TestingConfig, User, create_app, db, ensure_admin, init_schema  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    app = create_app(TestingConfig)
+    with app.app_context():
+        init_schema()
+        ensure_admin()
+
+        bob = User(username="bob", role="commercial")
+        bob.set_password("secret")
+        db.session.add(bob)
+        db.session.commit()
+
+        yield app
+
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def login(client, username, password, **kwargs):
+    return client.post(
+        "/login", data={"username": username, "password": password}, **kwargs
+    )
@@ -0,0 +1,155 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import event, text
+from sqlalchemy.exc import IntegrityError
+
+from app import (
+    Client, ClientStatusHistory, StatusCounter, User, db, funnel_by_commercial,
+    init_schema, rebuild_funnel,
+)
+
+from conftest import login
+
+
+def snapshot():
+    db.session.expire_all()
+    return sorted(
+        (c.user_id, c.status, c.count, c.entered, c.exits, round(c.seconds))
+        for c in StatusCounter.query.all()
+    )
+
+
+def assert_rebuild_matches():
+    live = snapshot()
+    rebuild_funnel()
+    assert snapshot() == live
+
+
+def bob():
+    return User.query.filter_by(username="bob").one()
+
+
+def test_dashboard_as_commercial(client):
+    db.session.add(Client(name="A", commercial="bob", user=bob()))
+    db.session.commit()
+
+    login(client, "bob", "secret")
+    resp = client.get("/dashboard")
+    assert resp.status_code == 200
+    assert "Pipeline par commercial" in resp.text
+
+
+def test_new_client_through_user_relationship(app):
+    client = Client(name="A", commercial="bob", user=bob())
+    db.session.add(client)
+    db.session.commit()
+
+    counter = db.session.get(StatusCounter, (bob().id, "en cours"))
+    assert (counter.count, counter.entered) == (1, 1)
+    assert ClientStatusHistory.query.filter_by(client_id=client.id).count() == 1
+
+
+def test_status_change_records_duration(app):
+    client = Client(name="A", commercial="bob", user=bob())
+    db.session.add(client)
+    db.session.commit()
+
+    # Recule l'entrée dans l'étape de deux jours
+    two_days_ago = datetime.utcnow() - timedelta(days=2)
+    client.status_since = two_days_ago
+    ClientStatusHistory.query.filter_by(client_id=client.id).update(
+        {"changed_at": two_days_ago}
+    )
+    db.session.commit()
+
+    client.status = "contrat signé"
+    db.session.commit()
+
+    stages = funnel_by_commercial(bob().id)[0]["stages"]
+    assert stages["en cours"]["count"] == 0
+    assert round(stages["en cours"]["avg_days"]) == 2
+    assert stages["contrat signé"]["count"] == 1
+    assert_rebuild_matches()
+
+
+def test_rebuild_matches_after_owner_change_and_deletes(app, client):
+    admin = User.query.filter_by(role="admin").one()
+    a = Client(name="A", commercial="bob", user=bob(), status="rdv fixé")
+    b = Client(name="B", commercial="bob", user=bob())
+    db.session.add_all([a, b])
+    db.session.commit()
+
+    a.status = "contrat signé"
+    b.user = admin
+    db.session.commit()
+    assert_rebuild_matches()
+
+    db.session.delete(a)
+    db.session.commit()
+    assert_rebuild_matches()
+
+    login(client, "admin", "admin123")
+    client.post(f"/admin/users/{bob().id}/delete")
+    assert StatusCounter.query.filter(StatusCounter.user_id != admin.id).count() == 0
+    assert_rebuild_matches()
+
+
+def test_counter_upsert_when_row_already_exists(app):
+    # Ligne créée entre-temps par un autre worker
+    db.session.execute(StatusCounter.__table__.insert().values(
+        user_id=bob().id, status="en cours", count=1, entered=1, exits=0, seconds=0,
+    ))
+    db.session.add(Client(name="A", commercial="bob", user=bob()))
+    db.session.commit()
+
+    assert db.session.get(StatusCounter, (bob().id, "en cours")).count == 2
+
+
+def test_init_schema_builds_counters_for_existing_clients(app):
+    db.session.execute(text(
+        "INSERT INTO client (name, commercial, status, user_id) "
+        "VALUES ('Ancien', 'bob', 'rdv fixé', :uid)"
+    ), {"uid": bob().id})
+    db.session.commit()
+
+    init_schema()
+    legacy = Client.query.filter_by(name="Ancien").one()
+    legacy.status = "refusé"
+    db.session.commit()
+
+    counts = {s: st["count"] for s, st in funnel_by_commercial(bob().id)[0]["stages"].items()}
+    assert counts["rdv fixé"] == 0
+    assert counts["refusé"] == 1
+    assert_rebuild_matches()
+
+
+def test_funnel_is_a_single_query(app):
+    db.session.add(Client(name="A", commercial="bob", user=bob()))
+    db.session.commit()
+    db.session.expire_all()
+
+    statements = []
+    listener = lambda *args: statements.append(args[2])  # noqa: E731
+    event.listen(db.engine, "before_cursor_execute", listener)
+    try:
+        funnel_by_commercial()
+    finally:
+        event.remove(db.engine, "before_cursor_execute", listener)
+
+    assert len(statements) == 1
+
+
+def test_failed_flush_does_not_replay_moves(app):
+    db.session.add(Client(name="A", commercial="bob", user=bob()))
+    db.session.add(Client(name="Sans propriétaire", commercial="bob", user_id=None))
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+
+    db.session.add(Client(name="B", commercial="bob", user=bob()))
+    db.session.commit()
+
+    assert Client.query.count() == 1
+    assert ClientStatusHistory.query.count() == 1
+    assert_rebuild_matches()
@@ -0,0 +1,101 @@
+from werkzeug.security import generate_password_hash
+
+import app as app_module
+from app import (
+    LoginPipeline, TestingConfig, TokenBucket, User, create_app, db, init_schema,
+)
+
+from conftest import login
+
+
+def test_login_success(client):
+    resp = login(client, "bob", "secret")
+    assert resp.status_code == 302
+    assert resp.location.endswith("/dashboard")
+
+
+def test_legacy_hash_is_rehashed(app, client):
+    bob = User.query.filter_by(username="bob").one()
+    bob.password_hash = generate_password_hash("secret", "pbkdf2:sha256:500")
+    db.session.commit()
+
+    assert login(client, "bob", "secret").status_code == 302
+
+    db.session.expire_all()
+    method = User.query.filter_by(username="bob").one().password_hash.split("$", 1)[0]
+    assert method == app.config["PASSWORD_HASH_METHOD"]
+
+
+def test_user_throttled_after_failures(app, client):
+    burst = app.config["LOGIN_USER_BURST"]
+    for _ in range(burst):
+        assert login(client, "bob", "mauvais").status_code == 200
+    assert login(client, "bob", "mauvais").status_code == 429
+
+
+def from_ip(ip):
+    return {"environ_base": {"REMOTE_ADDR": ip}}
+
+
+def test_empty_user_bucket_rejects_without_hashing(app, client, monkeypatch):
+    calls = []
+    real = app_module.check_password_hash
+    monkeypatch.setattr(app_module, "check_password_hash",
+                        lambda *args: calls.append(args) or real(*args))
+
+    burst = app.config["LOGIN_USER_BURST"]
+    for i in range(burst + 15):
+        login(client, "bob", "mauvais", **from_ip(f"10.0.0.{i}"))
+    assert len(calls) == burst
+
+    # Même le bon mot de passe est refusé depuis une IP inconnue
+    assert login(client, "bob", "secret", **from_ip("10.0.1.1")).status_code == 429
+    assert len(calls) == burst
+
+
+def test_known_ip_bypasses_user_lockout(app, client):
+    assert login(client, "bob", "secret", **from_ip("10.0.0.1")).status_code == 302
+    for i in range(app.config["LOGIN_USER_BURST"] + 2):
+        login(client, "bob", "mauvais", **from_ip(f"10.0.2.{i}"))
+    assert login(client, "bob", "secret", **from_ip("10.0.0.1")).status_code == 302
+
+
+def test_shorthand_hash_method_is_not_rehashed_every_login(app):
+    pipeline = LoginPipeline({**app.config, "PASSWORD_HASH_METHOD": "pbkdf2:sha256"})
+    current = generate_password_hash("secret", "pbkdf2:sha256")
+    assert not pipeline.needs_rehash(current)
+    assert pipeline.needs_rehash(generate_password_hash("secret", "pbkdf2:sha256:500"))
+
+
+def test_token_bucket_is_capped(monkeypatch):
+    monkeypatch.setattr(TokenBucket, "MAX_KEYS", 3)
+    bucket = TokenBucket(burst=1, per_minute=1)
+    for key in "abcde":
+        assert bucket.take(key)
+    assert len(bucket._buckets) == 3
+    assert not bucket.take("e")
+
+
+def test_successful_logins_do_not_drain_ip_bucket(app, client):
+    for _ in range(app.config["LOGIN_IP_BURST"] + 5):
+        assert login(client, "bob", "secret").status_code == 302
+
+
+def test_ip_bucket_uses_forwarded_for_behind_proxy():
+    class ProxyConfig(TestingConfig):
+        PROXY_FIX_COUNT = 1
+        LOGIN_IP_BURST = 2
+
+    app = create_app(ProxyConfig)
+    with app.app_context():
+        init_schema()
+        client = app.test_client()
+
+        for _ in range(2):
+            login(client, "bob", "mauvais", headers={"X-Forwarded-For": "10.0.0.1"})
+        assert login(client, "bob", "mauvais",
+                     headers={"X-Forwarded-For": "10.0.0.1"}).status_code == 429
+        assert login(client, "bob", "mauvais",
+                     headers={"X-Forwarded-For": "10.0.0.2"}).status_code == 200
+
+        db.drop_all()